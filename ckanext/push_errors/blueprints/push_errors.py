@@ -1,12 +1,58 @@
 import logging
+from datetime import datetime, timezone
 from flask import Blueprint
+from ckan.config.middleware.flask_app import csrf
+from ckan.lib.helpers import Page, get_page_number
 from ckan.plugins import toolkit
 from urllib.parse import unquote_plus
+from ckanext.push_errors.history import list_errors
+from ckanext.push_errors.profiler import MAX_WINDOW_SECONDS, open_profiling_window
 
 log = logging.getLogger(__name__)
 
 push_error_bp = Blueprint('push_errors', __name__, url_prefix='/push-error')
 
+HISTORY_PAGE_SIZE = 50
+
+
+@push_error_bp.route('/', methods=["GET"])
+def history():
+    """
+    List the local error history (latest first).
+    Only accessible by sysadmins.
+    """
+    if not toolkit.g.userobj or not toolkit.g.userobj.sysadmin:
+        return toolkit.abort(403, toolkit._('Unauthorized to access this page'))
+
+    filters = {
+        'fingerprint': toolkit.request.args.get('fingerprint'),
+        'path': toolkit.request.args.get('path'),
+    }
+    filters = {key: value for key, value in filters.items() if value}
+    page_number = get_page_number(toolkit.request.args)
+    offset = (page_number - 1) * HISTORY_PAGE_SIZE
+    total, errors = list_errors(offset=offset, limit=HISTORY_PAGE_SIZE, **filters)
+    for error in errors:
+        error['created'] = datetime.fromtimestamp(error['created'], timezone.utc)
+
+    def pager_url(q=None, page=None):
+        return toolkit.h.url_for('push_errors.history', page=page, **filters)
+
+    page = Page(
+        collection=errors,
+        page=page_number,
+        url=pager_url,
+        item_count=total,
+        items_per_page=HISTORY_PAGE_SIZE,
+        presliced_list=True,
+    )
+    extra_vars = {
+        'page': page,
+        'total': total,
+        'filters': filters,
+    }
+    return toolkit.render('push_errors/history.html', extra_vars)
+
 
 @push_error_bp.route('/test', methods=["GET"])
 def test_push_error():
@@ -43,3 +89,35 @@ def force_critical():
         return toolkit.abort(403)
     log.critical("Forced critical log message")
     return "Logged", 200
+
+
+@push_error_bp.route('/profile', methods=['GET', 'POST'])
+def profile():
+    """
+    Open a profiling window: slow requests are sampled and reported for some seconds.
+    GET shows the form, only POST changes the state.
+    Only accessible by sysadmins.
+    """
+    if not toolkit.g.userobj or not toolkit.g.userobj.sysadmin:
+        return toolkit.abort(403, toolkit._('Unauthorized to access this page'))
+
+    if toolkit.request.method == 'POST':
+        # Extension blueprints are exempt from CSRF checks by default
+        # (ckan.csrf_protection.ignore_extensions), so enforce it here.
+        # Like CKAN, skip it for requests authenticated with an API token.
+        if not toolkit.g.get('login_via_auth_header'):
+            csrf.protect()
+
+        try:
+            seconds = int(toolkit.request.form.get('seconds', 300))
+        except ValueError:
+            return toolkit.abort(400, toolkit._('Invalid seconds value'))
+
+        seconds = open_profiling_window(seconds)
+        toolkit.h.flash_success(toolkit._('Profiling slow requests for {} seconds').format(seconds))
+        return toolkit.redirect_to('push_errors.profile')
+
+    extra_vars = {
+        'max_seconds': MAX_WINDOW_SECONDS,
+    }
+    return toolkit.render('push_errors/profile.html', extra_vars)
@@ -1,5 +1,6 @@
 import click
 from ckanext.push_errors.cli.base import push_message_cli
+from ckanext.push_errors.cli.history import top_cli
 
 
 @click.group("push-errors", short_help='Push-Errors plugin management commands')
@@ -10,3 +11,4 @@ def push_errors():
 # Push-Errors commands
 # ===========================================
 push_errors.add_command(push_message_cli)
+push_errors.add_command(top_cli)
@@ -0,0 +1,28 @@
+import click
+from datetime import datetime
+from ckanext.push_errors.history import parse_duration, top_fingerprints
+
+
+@click.command('top', short_help='Most frequent errors')
+@click.option('--since', '-s', default='1h', help='Time window (e.g. 30m, 1h, 7d)')
+@click.option('--limit', '-l', default=20, type=int, help='Max errors to list')
+def top_cli(since, limit):
+    """ List the most frequent errors (by fingerprint) from the local history """
+
+    try:
+        seconds = parse_duration(since)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--since')
+
+    rows = top_fingerprints(since=seconds, limit=limit)
+    if not rows:
+        click.secho(f'No errors in the last {since}', fg='green')
+        return
+
+    click.secho(f'{"COUNT":>7}  {"LAST SEEN":19}  {"FINGERPRINT":12}  {"KIND":12}  PATH / SUMMARY', bold=True)
+    for row in rows:
+        last_seen = datetime.fromtimestamp(row['last_seen']).strftime('%Y-%m-%d %H:%M:%S')
+        click.echo(
+            f'{row["total"]:>7}  {last_seen}  {row["fingerprint"]:12}  {row["kind"]:12}  '
+            f'{row["path"]}  {row["summary"]}'
+        )
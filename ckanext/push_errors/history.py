@@ -0,0 +1,288 @@
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from ckan.plugins import toolkit
+from ckanext.push_errors.storage import get_storage_folder, make_private_folder, private_opener
+
+log = logging.getLogger(__name__)
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS errors (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created REAL NOT NULL,
+        fingerprint TEXT NOT NULL,
+        kind TEXT,
+        path TEXT,
+        user TEXT,
+        summary TEXT,
+        message TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS ix_errors_created ON errors (created)',
+    'CREATE INDEX IF NOT EXISTS ix_errors_fingerprint_created ON errors (fingerprint, created)',
+    'CREATE INDEX IF NOT EXISTS ix_errors_path_created ON errors (path, created)',
+)
+
+# Max pending entries for the writer. New entries are dropped if the writer falls behind
+QUEUE_SIZE = 1000
+# Max entries written in a single transaction
+BATCH_SIZE = 100
+# Seconds between retention prunes
+PRUNE_INTERVAL = 60
+# Max seconds to wait for the pending entries when the process exits
+FLUSH_TIMEOUT = 2
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def history_enabled():
+    """ The history is enabled by default, but only if there is a place to save it """
+    enabled = toolkit.asbool(toolkit.config.get('ckanext.push_errors.history.enabled', True))
+    return enabled and bool(get_history_path())
+
+
+def get_history_path():
+    """ Get the SQLite database file path (None if there is no place to save it) """
+    return toolkit.config.get('ckanext.push_errors.history.path') or get_storage_folder('history.db')
+
+
+def init_db(path):
+    """ Create the history database (only readable by the CKAN user) and open it for writing """
+    folder = os.path.dirname(path)
+    if folder:
+        make_private_folder(folder)
+    # Create the file with private permissions, SQLite uses the same for the WAL files
+    os.close(private_opener(path, os.O_RDWR | os.O_CREAT))
+    conn = sqlite3.connect(path, timeout=10)
+    # Allow readers (CLI, web) while the writer is working
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+def connect(path=None):
+    """ Open a read-only connection to the history database. None if it does not exist yet """
+    path = path or get_history_path()
+    if not path or not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def make_fingerprint(*parts):
+    """ Short stable hash to group the same error """
+    text = '|'.join(str(part) for part in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def exception_fingerprint(exception):
+    """
+    Group exceptions by type and the chain of functions where they were raised.
+    The innermost frame alone is usually library code (SQLAlchemy, werkzeug, toolkit.abort)
+    shared by unrelated errors.
+    """
+    exc_type = type(exception)
+    parts = [f'{exc_type.__module__}.{exc_type.__qualname__}']
+    tb = exception.__traceback__
+    while tb is not None:
+        frame = tb.tb_frame
+        parts.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+        tb = tb.tb_next
+    return make_fingerprint(*parts)
+
+
+def parse_duration(value):
+    """ Parse durations like 90s, 30m, 1h, 7d or 2w into seconds """
+    match = re.fullmatch(r'\s*(\d+)\s*([smhdw]?)\s*', value or '')
+    if not match:
+        raise ValueError(f'Invalid duration "{value}". Use something like 30m, 1h or 7d')
+    number, unit = match.groups()
+    return int(number) * DURATION_UNITS[unit or 's']
+
+
+def write_entries(conn, entries):
+    with conn:
+        conn.executemany(
+            'INSERT INTO errors (created, fingerprint, kind, path, user, summary, message) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            entries,
+        )
+
+
+def prune(conn, retention_days=30, max_rows=100000):
+    """ Remove the entries older than the retention days and keep max_rows at most """
+    with conn:
+        conn.execute('DELETE FROM errors WHERE created < ?', (time.time() - retention_days * 86400,))
+        conn.execute(
+            'DELETE FROM errors WHERE id <= (SELECT id FROM errors ORDER BY id DESC LIMIT 1 OFFSET ?)',
+            (max_rows,),
+        )
+
+
+class HistoryWriter:
+    """
+    Write the history entries from a background thread, in batches.
+    Senders only put the entry in a queue so they never wait for the disk.
+    The thread starts with the first entry.
+    """
+
+    def __init__(self, path, retention_days=30, max_rows=100000):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.pid = os.getpid()
+        self._thread = None
+        self._lock = threading.Lock()
+        # The thread is a daemon, do not lose the pending entries on exit
+        atexit.register(self.flush)
+
+    def put(self, entry):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='push-errors-history', daemon=True)
+                self._thread.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            log.warning('push-errors: History queue full, entry dropped')
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """ Wait (up to timeout seconds) until the pending entries are written """
+        if self.pid != os.getpid():
+            # Writer inherited from the parent process, its thread is not running here
+            return False
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self.queue.unfinished_tasks
+
+    def _run(self):
+        try:
+            conn = init_db(self.path)
+        except (OSError, sqlite3.Error) as e:
+            log.error(f'push-errors: Unable to open the history database {self.path}: {e}')
+            return
+
+        last_prune = 0
+        while True:
+            try:
+                entries = [self.queue.get(timeout=PRUNE_INTERVAL)]
+            except queue.Empty:
+                entries = []
+            while entries and len(entries) < BATCH_SIZE:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                if entries:
+                    write_entries(conn, entries)
+                if time.time() - last_prune >= PRUNE_INTERVAL:
+                    prune(conn, self.retention_days, self.max_rows)
+                    last_prune = time.time()
+            except sqlite3.Error as e:
+                log.error(f'push-errors: Unable to write the history: {e}')
+            finally:
+                # Allow waiting for the pending entries with flush() or queue.join()
+                for _ in entries:
+                    self.queue.task_done()
+
+
+def get_writer():
+    """ Get the history writer for this process """
+    global _writer
+    with _writer_lock:
+        # Threads do not survive a fork, start a new writer if required
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = HistoryWriter(
+                get_history_path(),
+                retention_days=int(toolkit.config.get('ckanext.push_errors.history.retention_days', 30)),
+                max_rows=int(toolkit.config.get('ckanext.push_errors.history.max_rows', 100000)),
+            )
+    return _writer
+
+
+def flush_history(timeout=FLUSH_TIMEOUT):
+    """
+    Wait for the pending entries of this process (if any).
+    Required before processes that exit without running atexit (e.g. rq work horses)
+    """
+    writer = _writer
+    if writer is None or writer.pid != os.getpid():
+        return True
+    return writer.flush(timeout)
+
+
+def record_error(message, fingerprint=None, kind=None, path=None, user=None):
+    """ Add an error to the local history (without blocking the caller) """
+    if not history_enabled():
+        return
+    summary = next((line.strip() for line in message.splitlines() if line.strip()), '')[:250]
+    fingerprint = fingerprint or make_fingerprint(summary)
+    get_writer().put((time.time(), fingerprint, kind or 'log', path or '-', user or '-', summary, message))
+
+
+def _filters(since=None, fingerprint=None, path=None):
+    where = []
+    params = []
+    if since:
+        where.append('created >= ?')
+        params.append(time.time() - since)
+    if fingerprint:
+        where.append('fingerprint = ?')
+        params.append(fingerprint)
+    if path:
+        where.append('path = ?')
+        params.append(path)
+    sql = f' WHERE {" AND ".join(where)}' if where else ''
+    return sql, params
+
+
+def top_fingerprints(since=3600, limit=20):
+    """ Most frequent errors in the last `since` seconds """
+    where, params = _filters(since=since)
+    # SQLite returns the bare columns from the row with MAX(created)
+    sql = (
+        'SELECT fingerprint, COUNT(*) AS total, MAX(created) AS last_seen, kind, path, summary '
+        f'FROM errors{where} GROUP BY fingerprint ORDER BY total DESC, last_seen DESC LIMIT ?'
+    )
+    conn = connect()
+    if conn is None:
+        return []
+    try:
+        return [dict(row) for row in conn.execute(sql, params + [limit])]
+    finally:
+        conn.close()
+
+
+def list_errors(offset=0, limit=50, fingerprint=None, path=None):
+    """ Latest errors first. Returns the total count and the requested page """
+    where, params = _filters(fingerprint=fingerprint, path=path)
+    conn = connect()
+    if conn is None:
+        return 0, []
+    try:
+        total = conn.execute(f'SELECT COUNT(*) FROM errors{where}', params).fetchone()[0]
+        rows = conn.execute(
+            f'SELECT * FROM errors{where} ORDER BY created DESC LIMIT ? OFFSET ?',
+            params + [limit, offset],
+        )
+        return total, [dict(row) for row in rows]
+    finally:
+        conn.close()
@@ -0,0 +1,238 @@
+import json
+import logging
+import time
+import traceback
+from datetime import datetime, timezone
+from rq.job import JobStatus
+from ckan.plugins import toolkit
+from ckanext.push_errors.history import exception_fingerprint, flush_history, make_fingerprint, record_error
+from ckanext.push_errors.logging import push_message
+from ckanext.push_errors.redis import get_cache
+
+log = logging.getLogger(__name__)
+
+# Redis list with the failures pending to be pushed (shared by all the workers)
+FAILURES_KEY = 'push_errors:jobs:failures'
+# Max pending failures to keep if nobody flushes them
+MAX_PENDING_FAILURES = 1000
+# Max failures listed in a single message
+MAX_LISTED_FAILURES = 20
+# Seconds to keep the "already buffered" mark for each failed job
+BUFFERED_MARK_TTL = 3600
+
+
+def _job_duration(job):
+    """ Seconds since the job started (rq uses naive UTC datetimes in older versions) """
+    started_at = getattr(job, 'started_at', None)
+    if not started_at:
+        return None
+    now = datetime.now(timezone.utc)
+    if started_at.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return (now - started_at).total_seconds()
+
+
+def _buffered_mark_key(job_id):
+    return f'{FAILURES_KEY}:{job_id}'
+
+
+def build_failure(job, error, trace, fingerprint):
+    """ Failure entry to be buffered in Redis """
+    from ckan.lib.jobs import remove_queue_name_prefix
+
+    max_trace_length = int(toolkit.config.get('ckanext.push_errors.traceback_length', 4000))
+    return {
+        'job_id': job.id,
+        'queue': remove_queue_name_prefix(job.origin),
+        'function': job.func_name,
+        'duration': _job_duration(job),
+        'error': error,
+        'trace': (trace or '')[:max_trace_length],
+        'fingerprint': fingerprint,
+        'failed_at': time.time(),
+    }
+
+
+def buffer_failure(failure):
+    """ Save the failure in Redis until a worker pushes it """
+    cache = get_cache()
+    pipe = cache.pipeline()
+    pipe.rpush(FAILURES_KEY, json.dumps(failure))
+    pipe.ltrim(FAILURES_KEY, -MAX_PENDING_FAILURES, -1)
+    pipe.set(_buffered_mark_key(failure['job_id']), 1, ex=BUFFERED_MARK_TTL)
+    pipe.execute()
+
+
+def job_exception_handler(job, exc_type, exc_value, tb):
+    """
+    rq exception handler. It runs in the work horse (the forked process), so the
+    failure is only buffered in Redis. The worker pushes all of them in batches.
+    """
+    try:
+        failure = build_failure(
+            job,
+            error=f'{exc_value} [({exc_type.__name__})]',
+            trace=''.join(traceback.format_exception(exc_type, exc_value, tb)),
+            fingerprint=exception_fingerprint(exc_value),
+        )
+        buffer_failure(failure)
+    except Exception as e:
+        log.error(f'push-errors: Unable to buffer the job failure: {e}')
+    # Continue with the next exception handlers
+    return True
+
+
+def _job_exc_string(job):
+    """ The error saved by rq for a failed job (the API changed in rq 1.12) """
+    latest_result = getattr(job, 'latest_result', None)
+    if latest_result is not None:
+        result = latest_result()
+        if result is not None and result.exc_string:
+            return result.exc_string
+    return getattr(job, 'exc_info', None)
+
+
+def buffer_unhandled_failure(job):
+    """
+    Buffer a failed job not seen by the exception handler.
+    If the work horse is killed (OOM, SIGKILL) rq marks the job as failed from the
+    main worker process without running the exception handlers.
+    Returns True if the failure was buffered.
+    """
+    if job.get_status(refresh=True) != JobStatus.FAILED:
+        return False
+    if get_cache().delete(_buffered_mark_key(job.id)):
+        # Already buffered by job_exception_handler
+        return False
+
+    trace = _job_exc_string(job) or 'Work-horse was terminated unexpectedly'
+    error = next((line.strip() for line in reversed(trace.splitlines()) if line.strip()), trace)
+    failure = build_failure(
+        job,
+        error=error,
+        trace=trace,
+        fingerprint=make_fingerprint(job.func_name, 'unhandled-failure'),
+    )
+    buffer_failure(failure)
+    return True
+
+
+def pending_job_failures():
+    """ Number of job failures waiting to be pushed """
+    return get_cache().llen(FAILURES_KEY)
+
+
+def format_failure(failure):
+    duration = failure.get('duration')
+    duration = f'{duration:.1f}s' if duration is not None else '-'
+    return (
+        f'`{failure["function"]}` [{failure["queue"]}] job {failure["job_id"]} '
+        f'after {duration}: `{failure["error"]}`'
+    )
+
+
+def flush_job_failures(force=False):
+    """
+    Push the buffered job failures in a single message.
+    Unless forced, wait until there are `batch_size` failures or the oldest one is
+    older than `flush_interval` seconds.
+    Returns the number of failures pushed.
+    """
+    cache = get_cache()
+    pending = cache.llen(FAILURES_KEY)
+    if not pending:
+        return 0
+
+    if not force:
+        batch_size = int(toolkit.config.get('ckanext.push_errors.jobs.batch_size', 20))
+        flush_interval = int(toolkit.config.get('ckanext.push_errors.jobs.flush_interval', 300))
+        raw_oldest = cache.lindex(FAILURES_KEY, 0)
+        if raw_oldest is None:
+            # Already flushed by another worker
+            return 0
+        oldest = json.loads(raw_oldest)
+        if pending < batch_size and time.time() - oldest['failed_at'] < flush_interval:
+            return 0
+
+    # Take all the failures at once, other workers could be flushing too
+    pipe = cache.pipeline()
+    pipe.lrange(FAILURES_KEY, 0, -1)
+    pipe.delete(FAILURES_KEY)
+    raw_failures, _ = pipe.execute()
+    failures = [json.loads(raw) for raw in raw_failures]
+    if not failures:
+        return 0
+
+    for failure in failures:
+        record_error(
+            f'JOB_FAILED {format_failure(failure)}\n```{failure["trace"]}```',
+            fingerprint=failure['fingerprint'],
+            kind='job',
+            path=f'job:{failure["function"]}',
+        )
+
+    listed = '\n'.join(f' - {format_failure(failure)}' for failure in failures[:MAX_LISTED_FAILURES])
+    if len(failures) > MAX_LISTED_FAILURES:
+        listed += f'\n - ... and {len(failures) - MAX_LISTED_FAILURES} more'
+    message = (
+        f'JOB_FAILURES {len(failures)} failed jobs\n'
+        f'{listed}\n\t'
+        f'TRACE (last failure)\n```{failures[-1]["trace"]}```'
+    )
+    push_message(message, extra_context={'kind': 'job'}, record=False)
+    return len(failures)
+
+
+def install_worker_hooks():
+    """
+    Capture the failures of the CKAN background jobs (`ckan jobs worker`).
+    Failures are buffered by an rq exception handler (or after the job, if the
+    work horse was killed) and pushed between jobs.
+    """
+    from ckan.lib.jobs import Worker
+
+    if getattr(Worker, '_push_errors_hooks', False):
+        return
+
+    original_init = Worker.__init__
+    original_execute_job = Worker.execute_job
+    original_perform_job = Worker.perform_job
+    original_register_death = Worker.register_death
+
+    def __init__(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self.push_exc_handler(job_exception_handler)
+
+    def execute_job(self, job, *args, **kwargs):
+        try:
+            return original_execute_job(self, job, *args, **kwargs)
+        finally:
+            try:
+                buffer_unhandled_failure(job)
+                if pending_job_failures():
+                    # Do not keep the failures if the worker is going idle
+                    idle = all(queue.is_empty() for queue in self.queues)
+                    flush_job_failures(force=idle)
+            except Exception as e:
+                log.error(f'push-errors: Unable to push the job failures: {e}')
+
+    def perform_job(self, job, *args, **kwargs):
+        try:
+            return original_perform_job(self, job, *args, **kwargs)
+        finally:
+            # The work horse exits with os._exit (no atexit), save its pending history
+            flush_history()
+
+    def register_death(self, *args, **kwargs):
+        try:
+            flush_job_failures(force=True)
+        except Exception as e:
+            log.error(f'push-errors: Unable to push the job failures: {e}')
+        return original_register_death(self, *args, **kwargs)
+
+    Worker.__init__ = __init__
+    Worker.execute_job = execute_job
+    Worker.perform_job = perform_job
+    Worker.register_death = register_death
+    Worker._push_errors_hooks = True
+    log.debug('push-errors: Background jobs worker hooks installed')
@@ -7,25 +7,27 @@ from ckan import __version__ as ckan_version
 from ckan.common import current_user
 from ckan.plugins import toolkit
 from ckanext.push_errors import __VERSION__ as push_errors_version
+from ckanext.push_errors.history import make_fingerprint, record_error
 from ckanext.push_errors.redis import get_cache
 
 log = logging.getLogger(__name__)
 
 
-def can_send_message():
+def can_send_message(key_prefix='push_errors', config_prefix='ckanext.push_errors', default_minute=3, default_hour=10):
     """
     Verifica si se puede enviar una nueva notificación según los límites definidos.
+    Other kinds of messages (e.g. profiles) can use their own limits with other prefixes.
     """
     cache = get_cache()
-    limit_minute = int(toolkit.config.get('ckanext.push_errors.max_messages_minute', 3))  # Default: 3
-    limit_hour = int(toolkit.config.get('ckanext.push_errors.max_messages_hour', 10))    # Default: 10
+    limit_minute = int(toolkit.config.get(f'{config_prefix}.max_messages_minute', default_minute))
+    limit_hour = int(toolkit.config.get(f'{config_prefix}.max_messages_hour', default_hour))
 
     current_minute = datetime.now().strftime('%Y%m%d%H%M')
     current_hour = datetime.now().strftime('%Y%m%d%H')
 
     # Claves para Redis
-    minute_key = f'push_errors:minute:{current_minute}'
-    hour_key = f'push_errors:hour:{current_hour}'
+    minute_key = f'{key_prefix}:minute:{current_minute}'
+    hour_key = f'{key_prefix}:hour:{current_hour}'
 
     # Incrementar contadores
     minute_count = cache.incr(minute_key)
@@ -63,10 +65,16 @@ class PushErrorHandler(Handler):
                 f'[{extras.get("name")}]::{extras.get("levelname")}::'
                 f'{extras.get("asctime")}'
             )
-            push_message(msg)
+            # Group by the unformatted message, not the final one
+            extra_context = {
+                'kind': 'log',
+                'fingerprint': make_fingerprint(record.name, record.msg),
+                'path': toolkit.request.path if toolkit.request else '-',
+            }
+            push_message(msg, extra_context=extra_context)
 
 
-def push_message(message, extra_context={}):
+def push_message(message, extra_context={}, record=True, check_limits=True):
     """
     Push a message to a URL
     Some params can be formated with these context vars
@@ -77,6 +85,12 @@ def push_message(message, extra_context={}):
      - {now}: The current datetime
      - {user}: The current user name (or "-")
     You can add more context vars in extra_context
+    These extra_context vars are also used for the local error history:
+     - {kind}: The kind of error (request, log, etc)
+     - {fingerprint}: A hash to group the same errors
+     - {path}: The request path (if any)
+    Use record=False if the caller already saved the error in the history
+    Use check_limits=False if the caller already checked its own limits (see can_send_message)
     Expected CKAN config values:
      - ckanext.push_errors.url: The URL to push the message
      - ckanext.push_errors.method: The method to use (POST or GET)
@@ -84,7 +98,17 @@ def push_message(message, extra_context={}):
      - ckanext.push_errors.data: A JSON string with the data to send
     """
 
-    if not can_send_message():
+    # Keep a local history, even for the messages dropped by the limits
+    if record:
+        record_error(
+            message,
+            fingerprint=extra_context.get('fingerprint'),
+            kind=extra_context.get('kind'),
+            path=extra_context.get('path'),
+            user=current_user.name if current_user else '-',
+        )
+
+    if check_limits and not can_send_message():
         log.info('push-errors: Message not sent due to notification limit.')
         return None
 
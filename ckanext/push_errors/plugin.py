@@ -4,7 +4,10 @@ from werkzeug.exceptions import Forbidden, Unauthorized, NotFound
 from ckan import plugins
 from ckan.common import current_user
 from ckan.plugins import toolkit
+from ckanext.push_errors.history import exception_fingerprint
+from ckanext.push_errors.jobs import install_worker_hooks
 from ckanext.push_errors.logging import PushErrorHandler, push_message
+from ckanext.push_errors.profiler import start_request_profile, finish_request_profile
 from ckanext.push_errors.cli import push_errors as push_errors_commands
 
 from ckanext.push_errors.blueprints.push_errors import push_error_bp
@@ -13,10 +16,24 @@ log = logging.getLogger(__name__)
 
 
 class PushErrorsPlugin(plugins.SingletonPlugin):
+    plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IClick)
     plugins.implements(plugins.IMiddleware)
     plugins.implements(plugins.IBlueprint)
 
+    # IConfigurer
+
+    def update_config(self, config_):
+        toolkit.add_template_directory(config_, 'templates')
+
+    # IConfigurable
+
+    def configure(self, config_):
+        # Capture the background jobs failures (ckan jobs worker)
+        if toolkit.asbool(config_.get('ckanext.push_errors.jobs.enabled', True)):
+            install_worker_hooks()
+
     # IMiddleware
 
     def make_middleware(self, app, config):
@@ -60,12 +77,21 @@ class PushErrorsPlugin(plugins.SingletonPlugin):
                 f'params: {params}\n\t'
                 f'by user *{user}*'
             )
-            push_message(error_message)
+            extra_context = {
+                'kind': 'request',
+                'fingerprint': exception_fingerprint(exception),
+                'path': path,
+            }
+            push_message(error_message, extra_context=extra_context)
             # Continue to raise the error
             raise exception
 
         app.register_error_handler(Exception, error_handler)
 
+        # Sample slow requests (only when the profiler is enabled or a window is open)
+        app.before_request(start_request_profile)
+        app.teardown_request(finish_request_profile)
+
         return app
 
     def make_error_log_middleware(self, app, config):
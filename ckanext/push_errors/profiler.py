@@ -0,0 +1,300 @@
+import glob
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from ckan.plugins import toolkit
+from ckanext.push_errors.history import make_fingerprint
+from ckanext.push_errors.logging import can_send_message, push_message
+from ckanext.push_errors.redis import get_cache
+from ckanext.push_errors.storage import get_storage_folder, make_private_folder, private_opener
+
+log = logging.getLogger(__name__)
+
+# Redis key shared by all the web workers to open a profiling window
+WINDOW_KEY = 'push_errors:profiler:window'
+# Max seconds a sysadmin can open a profiling window for
+MAX_WINDOW_SECONDS = 3600
+# How often (seconds) each process checks Redis for an open window
+WINDOW_CHECK_INTERVAL = 1
+# Max slow requests waiting to be reported. New ones are dropped if the reporter falls behind
+REPORT_QUEUE_SIZE = 20
+
+_window = {'checked_at': 0, 'open': False}
+_sampler = None
+_sampler_lock = threading.Lock()
+_reporter = None
+_reporter_lock = threading.Lock()
+
+
+def collapse_stack(frame):
+    """ Build a collapsed stack line (root first, `;` separated) from a frame """
+    stack = []
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '?')
+        stack.append(f'{module}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class StackSampler:
+    """
+    Sample the stacks of the registered threads from a single daemon thread.
+    The sampler sleeps (without polling) while there is nothing to profile.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._targets = {}
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        """ Start collecting samples for a thread """
+        with self._lock:
+            self._targets[thread_id] = Counter()
+            self._ensure_thread()
+            self._active.set()
+
+    def stop(self, thread_id):
+        """ Stop collecting samples for a thread and return them """
+        with self._lock:
+            samples = self._targets.pop(thread_id, Counter())
+            if not self._targets:
+                self._active.clear()
+        return samples
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, start a new one if required
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='push-errors-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[collapse_stack(frame)] += 1
+            # Do not keep references to the sampled frames
+            del frames
+
+
+class ProfileReporter:
+    """
+    Save and push the profiles from a background thread.
+    The request only puts the samples in a queue, it never waits for the disk or the webhook.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=REPORT_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, samples, elapsed_ms, path):
+        with self._lock:
+            # Threads do not survive a fork, start a new one if required
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='push-errors-profiles', daemon=True)
+                self._thread.start()
+        try:
+            self.queue.put_nowait((samples, elapsed_ms, path))
+        except queue.Full:
+            log.warning(f'push-errors: Profile queue full, profile for {path} dropped')
+
+    def _run(self):
+        while True:
+            samples, elapsed_ms, path = self.queue.get()
+            try:
+                report_profile(samples, elapsed_ms, path)
+            except Exception as e:
+                log.error(f'push-errors: Unable to report the profile for {path}: {e}')
+            finally:
+                self.queue.task_done()
+
+
+def get_reporter():
+    """ Get the process-wide profile reporter """
+    global _reporter
+    with _reporter_lock:
+        if _reporter is None:
+            _reporter = ProfileReporter()
+    return _reporter
+
+
+def get_sampler():
+    """ Get the process-wide stack sampler """
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            interval_ms = int(toolkit.config.get('ckanext.push_errors.profiler.interval_ms', 10))
+            _sampler = StackSampler(interval=interval_ms / 1000)
+    return _sampler
+
+
+def open_profiling_window(seconds):
+    """ Profile all the requests (in all the web workers) for some seconds """
+    seconds = max(1, min(int(seconds), MAX_WINDOW_SECONDS))
+    cache = get_cache()
+    cache.set(WINDOW_KEY, int(time.time()) + seconds, ex=seconds)
+    # Force the next check in this process
+    _window['checked_at'] = 0
+    log.info(f'push-errors: Profiling window open for {seconds} seconds')
+    return seconds
+
+
+def profiling_window_open():
+    """ Check (at most once per WINDOW_CHECK_INTERVAL) if a profiling window is open """
+    now = time.monotonic()
+    if now - _window['checked_at'] < WINDOW_CHECK_INTERVAL:
+        return _window['open']
+
+    _window['checked_at'] = now
+    try:
+        _window['open'] = bool(get_cache().exists(WINDOW_KEY))
+    except Exception as e:
+        log.debug(f'push-errors: Unable to check the profiling window: {e}')
+        _window['open'] = False
+    return _window['open']
+
+
+def profiling_requested():
+    """ Check if the current request must be profiled """
+    if toolkit.asbool(toolkit.config.get('ckanext.push_errors.profiler.enabled', False)):
+        return True
+    return profiling_window_open()
+
+
+def start_request_profile():
+    """ Flask before_request hook. Start sampling the current thread if required """
+    if not profiling_requested():
+        return
+    toolkit.g.push_errors_profile_start = time.monotonic()
+    get_sampler().start(threading.get_ident())
+
+
+def finish_request_profile(exception=None):
+    """
+    Flask teardown_request hook. Report the profile if the request was slow.
+    This runs before the response is sent, so the report is done in the background.
+    """
+    started = getattr(toolkit.g, 'push_errors_profile_start', None)
+    if started is None:
+        return
+    toolkit.g.push_errors_profile_start = None
+
+    samples = get_sampler().stop(threading.get_ident())
+    elapsed_ms = (time.monotonic() - started) * 1000
+    threshold_ms = int(toolkit.config.get('ckanext.push_errors.profiler.threshold_ms', 2000))
+    if elapsed_ms < threshold_ms or not samples:
+        return
+
+    path = toolkit.request.path if toolkit.request else '-'
+    get_reporter().put(samples, elapsed_ms, path)
+
+
+def top_functions(samples, limit=10):
+    """ Get the functions with more self samples (the leaf of each stack) """
+    leaves = Counter()
+    for stack, count in samples.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return leaves.most_common(limit)
+
+
+def get_profiles_folder():
+    """ Folder for the collapsed stacks (None if there is no place to save them) """
+    return toolkit.config.get('ckanext.push_errors.profiler.path') or get_storage_folder('profiles')
+
+
+def prune_profiles(folder):
+    """ Keep only the newest `max_files` profiles, none older than `retention_days` """
+    max_files = int(toolkit.config.get('ckanext.push_errors.profiler.max_files', 100))
+    retention_days = int(toolkit.config.get('ckanext.push_errors.profiler.retention_days', 7))
+    oldest = time.time() - retention_days * 86400
+    profiles = []
+    for filename in glob.glob(os.path.join(folder, '*.collapsed')):
+        try:
+            profiles.append((os.path.getmtime(filename), filename))
+        except OSError:
+            # Already removed by another worker
+            continue
+    profiles.sort(reverse=True)
+    for position, (mtime, filename) in enumerate(profiles):
+        if position < max_files and mtime >= oldest:
+            continue
+        try:
+            os.remove(filename)
+        except OSError as e:
+            log.warning(f'push-errors: Unable to remove the profile {filename}: {e}')
+
+
+def save_collapsed_stacks(samples, path):
+    """ Save the samples in the collapsed stack format (flamegraph.pl, speedscope, etc) """
+    folder = get_profiles_folder()
+    if not folder:
+        log.debug('push-errors: No profiler path (or ckan.storage_path) configured, profile not saved')
+        return None
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_')[:60] or 'root'
+    filename = os.path.join(folder, f'{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{slug}.collapsed')
+    try:
+        make_private_folder(folder)
+        with open(filename, 'w', opener=private_opener) as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        prune_profiles(folder)
+    except OSError as e:
+        log.error(f'push-errors: Unable to save the profile {filename}: {e}')
+        return None
+    return filename
+
+
+def can_send_profile():
+    """ Profiles have their own limits, so they never use the budget of the errors """
+    return can_send_message(
+        key_prefix='push_errors:profiler',
+        config_prefix='ckanext.push_errors.profiler',
+        default_minute=1,
+        default_hour=5,
+    )
+
+
+def report_profile(samples, elapsed_ms, path):
+    """
+    Save the profile locally and push a summary with the hottest functions.
+    Profiles are always saved (max_files and retention_days bound the disk),
+    the profiler limits only apply to the pushed message.
+    """
+    filename = save_collapsed_stacks(samples, path)
+    if not can_send_profile():
+        log.info(f'push-errors: Profile for {path} saved in {filename} but not pushed due to the profiler limits.')
+        return None
+
+    total = sum(samples.values())
+    limit = int(toolkit.config.get('ckanext.push_errors.profiler.top', 10))
+    top = '\n'.join(
+        f'{count:>6} {count * 100 / total:5.1f}%  {function}'
+        for function, count in top_functions(samples, limit)
+    )
+
+    message = (
+        f'SLOW_REQUEST `{path}` took {elapsed_ms:.0f} ms\n\t'
+        f'TOP FUNCTIONS ({total} samples)\n```{top}```\n\t'
+        f'profile: {filename or "-"}'
+    )
+    extra_context = {
+        'kind': 'slow-request',
+        'fingerprint': make_fingerprint('slow-request', path),
+        'path': path,
+    }
+    return push_message(message, extra_context=extra_context, check_limits=False)
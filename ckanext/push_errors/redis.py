@@ -5,13 +5,16 @@ from ckan.plugins import toolkit
 
 log = logging.getLogger(__name__)
 
+# One client (and connection pool) per Redis URL. redis-py pools are fork-safe
+_caches = {}
+
 
 def get_cache():
     """ Get the Redis cache connection """
-    log.debug('Getting Redis cache connection')
-
     redis_url = toolkit.config.get('ckan.redis.url', 'redis://localhost:6379/0')
-    redis_pool = ConnectionPool.from_url(redis_url)
-    cache = Redis(connection_pool=redis_pool)
-    log.info(f'Connected to Redis cache at {redis_url}')
+    cache = _caches.get(redis_url)
+    if cache is None:
+        redis_pool = ConnectionPool.from_url(redis_url)
+        cache = _caches[redis_url] = Redis(connection_pool=redis_pool)
+        log.info(f'Connected to Redis cache at {redis_url}')
     return cache
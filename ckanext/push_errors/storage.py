@@ -0,0 +1,26 @@
+import os
+from ckan.plugins import toolkit
+
+
+def get_storage_folder(*parts):
+    """ Folder for the local files of this extension, under ckan.storage_path (if any) """
+    storage_path = toolkit.config.get('ckan.storage_path')
+    if not storage_path:
+        return None
+    return os.path.join(storage_path, 'push_errors', *parts)
+
+
+def make_private_folder(folder):
+    """
+    Create a folder only accessible by the CKAN user.
+    Refuse to use a folder owned by other user (e.g. created in advance in a shared place).
+    """
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if os.stat(folder).st_uid != os.getuid():
+        raise OSError(f'{folder} is not owned by the CKAN user')
+    return folder
+
+
+def private_opener(path, flags):
+    """ Opener for open() to create files only readable by the CKAN user """
+    return os.open(path, flags, 0o600)
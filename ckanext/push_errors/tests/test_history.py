@@ -0,0 +1,253 @@
+import os
+import time
+from datetime import datetime, timezone
+from unittest import mock
+import pytest
+from ckan.lib.helpers import url_for
+from ckan.tests import factories
+from ckanext.push_errors import history
+from ckanext.push_errors.cli.history import top_cli
+from ckanext.push_errors.history import (
+    connect, exception_fingerprint, flush_history, init_db, list_errors, parse_duration, prune, record_error,
+    top_fingerprints, write_entries,
+)
+
+
+@pytest.fixture
+def history_db(tmp_path, ckan_config, monkeypatch):
+    """ Use a new history database (and writer) for each test """
+    path = str(tmp_path / 'history.db')
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.history.path', path)
+    monkeypatch.setattr(history, '_writer', None)
+    return path
+
+
+def add_errors(path, entries):
+    """ Write entries (fingerprint, created, path) synchronously """
+    conn = init_db(path)
+    try:
+        write_entries(conn, [
+            (created, fingerprint, 'request', page, '-', f'Error {fingerprint}', f'Error {fingerprint}\nTRACE')
+            for fingerprint, created, page in entries
+        ])
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('45', 45), ('90s', 90), ('30m', 1800), ('1h', 3600), ('7d', 604800), ('2w', 1209600),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['', 'h', '1y', '-1h', 'one hour'])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+
+def library_call(value):
+    """ Emulate library code shared by unrelated errors (e.g. toolkit.abort) """
+    raise ValueError(value)
+
+
+def view_one(value):
+    library_call(value)
+
+
+def view_two(value):
+    library_call(value)
+
+
+def fingerprint_for(view, value):
+    try:
+        view(value)
+    except ValueError as e:
+        return exception_fingerprint(e)
+
+
+def test_exception_fingerprint():
+    """ The same error from the same place has the same fingerprint, whatever the message """
+    assert fingerprint_for(view_one, 'first') == fingerprint_for(view_one, 'second')
+    assert fingerprint_for(view_one, 'first') != exception_fingerprint(KeyError('first'))
+
+
+def test_exception_fingerprint_shared_library_code():
+    """ Errors raised by the same library function from different places are not grouped """
+    assert fingerprint_for(view_one, 'first') != fingerprint_for(view_two, 'first')
+
+
+def test_record_error_is_written(history_db):
+    record_error('INTERNAL_ERROR `boom`\n\tTRACE', fingerprint='abc', kind='request', path='/dataset/', user='joe')
+    assert flush_history()
+
+    total, errors = list_errors()
+    assert total == 1
+    assert errors[0]['fingerprint'] == 'abc'
+    assert errors[0]['path'] == '/dataset/'
+    assert errors[0]['user'] == 'joe'
+    assert errors[0]['summary'] == 'INTERNAL_ERROR `boom`'
+
+
+@pytest.mark.ckan_config('ckanext.push_errors.history.enabled', 'false')
+def test_record_error_disabled(history_db):
+    record_error('Not saved')
+    assert history._writer is None
+
+
+def test_record_error_without_path(ckan_config, monkeypatch):
+    """ Without a history path (or ckan.storage_path) the history is disabled """
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.history.path', '')
+    monkeypatch.setitem(ckan_config, 'ckan.storage_path', '')
+    monkeypatch.setattr(history, '_writer', None)
+    record_error('Not saved')
+    assert history._writer is None
+
+
+def test_default_path_under_storage_path(tmp_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.history.path', '')
+    monkeypatch.setitem(ckan_config, 'ckan.storage_path', str(tmp_path))
+    assert history.get_history_path() == str(tmp_path / 'push_errors' / 'history.db')
+
+
+def test_history_is_private(tmp_path):
+    path = tmp_path / 'history' / 'history.db'
+    init_db(str(path)).close()
+    assert os.stat(path.parent).st_mode & 0o777 == 0o700
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_reads_do_not_create_the_database(history_db):
+    assert connect() is None
+    assert top_fingerprints() == []
+    assert list_errors() == (0, [])
+    assert not os.path.exists(history_db)
+
+
+def test_top_fingerprints(history_db):
+    now = time.time()
+    add_errors(history_db, [
+        ('aaa', now - 10, '/a'),
+        ('bbb', now - 20, '/b'),
+        ('bbb', now - 30, '/b'),
+        ('ccc', now - 7200, '/c'),
+    ])
+
+    top = top_fingerprints(since=3600)
+    assert [(row['fingerprint'], row['total']) for row in top] == [('bbb', 2), ('aaa', 1)]
+    assert top[0]['last_seen'] == pytest.approx(now - 20)
+
+
+def test_list_errors_filters_and_pagination(history_db):
+    now = time.time()
+    add_errors(history_db, [('aaa', now - i, '/a' if i % 2 else '/b') for i in range(10)])
+
+    total, errors = list_errors(offset=0, limit=3)
+    assert total == 10
+    assert len(errors) == 3
+    assert errors[0]['created'] > errors[1]['created']
+
+    total, errors = list_errors(offset=3, limit=50, path='/a')
+    assert total == 5
+    assert len(errors) == 2
+
+
+def test_prune(history_db):
+    now = time.time()
+    add_errors(history_db, [
+        ('old', now - 40 * 86400, '/a'),
+        ('aaa', now - 3, '/a'),
+        ('bbb', now - 2, '/a'),
+        ('ccc', now - 1, '/a'),
+    ])
+    conn = init_db(history_db)
+    try:
+        prune(conn, retention_days=30, max_rows=2)
+    finally:
+        conn.close()
+
+    _total, errors = list_errors()
+    assert [error['fingerprint'] for error in errors] == ['ccc', 'bbb']
+
+
+def test_top_cli(cli, history_db):
+    add_errors(history_db, [('aaa', time.time() - 10, '/dataset/')])
+    result = cli.invoke(top_cli, ['--since', '1h'])
+    assert result.exit_code == 0
+    assert 'aaa' in result.output
+    assert '/dataset/' in result.output
+
+
+def test_top_cli_invalid_since(cli, history_db):
+    result = cli.invoke(top_cli, ['--since', 'yesterday'])
+    assert result.exit_code != 0
+    assert 'Invalid duration' in result.output
+
+
+@mock.patch('ckanext.push_errors.logging.record_error')
+@mock.patch('ckanext.push_errors.logging.can_send_message', return_value=False)
+def test_push_message_records_dropped_messages(_can_send, mock_record_error):
+    """ Messages dropped by the limits are still saved in the history """
+    from ckanext.push_errors.logging import push_message
+    push_message('Test message', extra_context={'fingerprint': 'abc', 'path': '/a', 'kind': 'request'})
+    mock_record_error.assert_called_once_with(
+        'Test message', fingerprint='abc', kind='request', path='/a', user=mock.ANY
+    )
+
+
+class TestHistoryView:
+    """Tests for the error history view"""
+
+    def test_unauthorized_not_sysadmin(self, app, history_db):
+        user_with_token = factories.UserWithToken()
+        auth = {"Authorization": user_with_token['token']}
+        response = app.get(url_for('push_errors.history'), headers=auth)
+        assert response.status_code == 403
+
+    def test_sysadmin_list(self, app, history_db):
+        add_errors(history_db, [('aaa', time.time() - 10, '/dataset/'), ('bbb', time.time() - 5, '/group/')])
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        response = app.get(url_for('push_errors.history'), headers=auth)
+
+        assert response.status_code == 200
+        assert b'Error aaa' in response.data
+        assert b'Error bbb' in response.data
+
+    def test_sysadmin_filter_by_fingerprint(self, app, history_db):
+        add_errors(history_db, [('aaa', time.time() - 10, '/dataset/'), ('bbb', time.time() - 5, '/group/')])
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        response = app.get(url_for('push_errors.history', fingerprint='bbb'), headers=auth)
+
+        assert response.status_code == 200
+        assert b'Error aaa' not in response.data
+        assert b'Error bbb' in response.data
+
+    def test_sysadmin_pagination(self, app, history_db):
+        now = time.time()
+        add_errors(history_db, [(f'fp{i:03d}', now - i, '/dataset/') for i in range(60)])
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+
+        response = app.get(url_for('push_errors.history'), headers=auth)
+        assert b'Error fp000' in response.data
+        assert b'Error fp059' not in response.data
+
+        response = app.get(url_for('push_errors.history', page=2), headers=auth)
+        assert response.status_code == 200
+        assert b'Error fp000' not in response.data
+        assert b'Error fp059' in response.data
+
+    @mock.patch('ckanext.push_errors.blueprints.push_errors.toolkit.render', return_value='')
+    def test_created_is_utc(self, mock_render, app, history_db):
+        """ render_datetime expects aware (or UTC) datetimes """
+        created = time.time() - 10
+        add_errors(history_db, [('aaa', created, '/dataset/')])
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        app.get(url_for('push_errors.history'), headers=auth)
+
+        page = mock_render.call_args[0][1]['page']
+        assert page.items[0]['created'] == datetime.fromtimestamp(created, timezone.utc)
@@ -0,0 +1,182 @@
+import json
+import os
+import signal
+import time
+from unittest import mock
+import pytest
+from ckan.lib import jobs
+from ckanext.push_errors.jobs import (
+    FAILURES_KEY, MAX_LISTED_FAILURES, buffer_unhandled_failure, flush_job_failures, install_worker_hooks,
+    job_exception_handler, pending_job_failures,
+)
+from ckanext.push_errors.redis import get_cache
+
+
+def failing_job():
+    raise ValueError('Harvest failed')
+
+
+def killed_job():
+    # Emulate the OOM killer
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+@pytest.fixture
+def clean_failures():
+    cache = get_cache()
+    cache.delete(FAILURES_KEY, f'{FAILURES_KEY}:job-1')
+    yield cache
+    cache.delete(FAILURES_KEY, f'{FAILURES_KEY}:job-1')
+
+
+def add_failure(failed_at=None):
+    """ Buffer a failure like the work horse does """
+    job = mock.MagicMock(id='job-1', origin=jobs.add_queue_name_prefix('default'), func_name='ckanext.harvest.run')
+    job.started_at = None
+    try:
+        failing_job()
+    except ValueError as e:
+        job_exception_handler(job, type(e), e, e.__traceback__)
+    if failed_at:
+        cache = get_cache()
+        failure = json.loads(cache.rpop(FAILURES_KEY))
+        failure['failed_at'] = failed_at
+        cache.rpush(FAILURES_KEY, json.dumps(failure))
+
+
+def test_exception_handler_buffers_failure(clean_failures):
+    add_failure()
+
+    assert pending_job_failures() == 1
+    failure = json.loads(clean_failures.lindex(FAILURES_KEY, 0))
+    assert failure['job_id'] == 'job-1'
+    assert failure['queue'] == 'default'
+    assert failure['function'] == 'ckanext.harvest.run'
+    assert failure['error'] == 'Harvest failed [(ValueError)]'
+    assert 'failing_job' in failure['trace']
+    # Mark to not buffer the same failure again from the main worker process
+    assert clean_failures.exists(f'{FAILURES_KEY}:job-1')
+
+
+def test_unhandled_failure_is_buffered(clean_failures):
+    """ Jobs failed without running the exception handlers (killed work horse) """
+    job = mock.MagicMock(id='job-1', origin=jobs.add_queue_name_prefix('default'), func_name='ckanext.harvest.run')
+    job.started_at = None
+    job.get_status.return_value = 'failed'
+    job.latest_result.return_value.exc_string = 'Work-horse terminated unexpectedly; waitpid returned 9'
+
+    assert buffer_unhandled_failure(job)
+    failure = json.loads(clean_failures.lindex(FAILURES_KEY, 0))
+    assert failure['queue'] == 'default'
+    assert failure['error'] == 'Work-horse terminated unexpectedly; waitpid returned 9'
+
+
+def test_handled_failure_is_not_buffered_twice(clean_failures):
+    add_failure()
+    job = mock.MagicMock(id='job-1')
+    job.get_status.return_value = 'failed'
+
+    assert not buffer_unhandled_failure(job)
+    assert pending_job_failures() == 1
+
+
+def test_finished_job_is_not_buffered(clean_failures):
+    job = mock.MagicMock(id='job-1')
+    job.get_status.return_value = 'finished'
+
+    assert not buffer_unhandled_failure(job)
+    assert pending_job_failures() == 0
+
+
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_flush_waits_for_batch(mock_push_message, mock_record_error, clean_failures):
+    add_failure()
+    assert flush_job_failures() == 0
+    mock_push_message.assert_not_called()
+    assert pending_job_failures() == 1
+
+
+@pytest.mark.ckan_config('ckanext.push_errors.jobs.batch_size', '2')
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_flush_full_batch(mock_push_message, mock_record_error, clean_failures):
+    add_failure()
+    add_failure()
+    assert flush_job_failures() == 2
+
+    mock_push_message.assert_called_once()
+    msg = mock_push_message.call_args[0][0]
+    assert 'JOB_FAILURES 2 failed jobs' in msg
+    assert '`ckanext.harvest.run` [default] job job-1' in msg
+    assert mock_push_message.call_args[1]['record'] is False
+    # Each failure is saved in the history
+    assert mock_record_error.call_count == 2
+    assert pending_job_failures() == 0
+
+
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_flush_old_failures(mock_push_message, mock_record_error, clean_failures):
+    add_failure(failed_at=time.time() - 3600)
+    assert flush_job_failures() == 1
+    mock_push_message.assert_called_once()
+
+
+@mock.patch('ckanext.push_errors.jobs.push_message')
+@mock.patch('ckanext.push_errors.jobs.get_cache')
+def test_flush_failures_flushed_by_other_worker(mock_get_cache, mock_push_message):
+    """ The failures can be taken by another worker between llen and lindex """
+    mock_get_cache.return_value.llen.return_value = 1
+    mock_get_cache.return_value.lindex.return_value = None
+    assert flush_job_failures() == 0
+    mock_push_message.assert_not_called()
+
+
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_flush_forced_lists_max_failures(mock_push_message, mock_record_error, clean_failures):
+    for _ in range(MAX_LISTED_FAILURES + 5):
+        add_failure()
+    assert flush_job_failures(force=True) == MAX_LISTED_FAILURES + 5
+
+    msg = mock_push_message.call_args[0][0]
+    assert '... and 5 more' in msg
+
+
+def test_worker_hooks_installed():
+    install_worker_hooks()
+    # Installing twice must not wrap the worker twice
+    install_worker_hooks()
+    worker = jobs.Worker()
+    assert worker._exc_handlers.count(job_exception_handler) == 1
+
+
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_worker_pushes_failed_job(mock_push_message, mock_record_error, clean_failures):
+    """ The failure is pushed when the worker has no more jobs """
+    install_worker_hooks()
+    jobs.get_queue().empty()
+    jobs.enqueue(failing_job)
+    jobs.Worker().work(burst=True)
+
+    mock_push_message.assert_called_once()
+    msg = mock_push_message.call_args[0][0]
+    assert 'JOB_FAILURES 1 failed jobs' in msg
+    assert 'Harvest failed' in msg
+
+
+@mock.patch('ckanext.push_errors.jobs.record_error')
+@mock.patch('ckanext.push_errors.jobs.push_message')
+def test_worker_pushes_killed_job(mock_push_message, mock_record_error, clean_failures):
+    """ Work horses killed (e.g. OOM) do not run the exception handlers """
+    install_worker_hooks()
+    jobs.get_queue().empty()
+    jobs.enqueue(killed_job)
+    jobs.Worker().work(burst=True)
+
+    mock_push_message.assert_called_once()
+    msg = mock_push_message.call_args[0][0]
+    assert 'JOB_FAILURES 1 failed jobs' in msg
+    assert 'killed_job' in msg
@@ -85,4 +85,4 @@ class TestPushErrorLogging:
             push_error_handler = PushErrorHandler()
             log.addHandler(push_error_handler)
             log.critical("This is a critical error!")
-            mock_push_message.assert_called_once_with(ANY)
+            mock_push_message.assert_called_once_with(ANY, extra_context=ANY)
@@ -0,0 +1,232 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from unittest import mock
+import pytest
+from ckan.lib.helpers import url_for
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckanext.push_errors import profiler
+from ckanext.push_errors.blueprints.push_errors import profile
+from ckanext.push_errors.profiler import (
+    ProfileReporter, StackSampler, collapse_stack, prune_profiles, top_functions, save_collapsed_stacks,
+    report_profile,
+)
+from ckanext.push_errors.redis import get_cache
+
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_collapse_stack():
+    """ The current function is the last one in the collapsed stack """
+    stack = collapse_stack(sys._getframe())
+    assert stack.endswith(f'{__name__}:test_collapse_stack')
+    assert ' ' not in stack
+
+
+def test_sampler_collects_samples():
+    """ The sampler collects the stacks of the registered thread only """
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_function, args=(stop,))
+    thread.start()
+    sampler = StackSampler(interval=0.001)
+    try:
+        sampler.start(thread.ident)
+        time.sleep(0.1)
+        samples = sampler.stop(thread.ident)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert sum(samples.values()) > 0
+    assert any(f'{__name__}:busy_function' in stack for stack in samples)
+    # Nothing else to sample
+    assert not sampler._active.is_set()
+
+
+def test_top_functions():
+    samples = Counter({
+        'a:main;b:load;c:parse': 5,
+        'a:main;c:parse': 3,
+        'a:main;b:load': 1,
+    })
+    assert top_functions(samples, 2) == [('c:parse', 8), ('b:load', 1)]
+
+
+def test_save_collapsed_stacks(tmp_path, ckan_config, monkeypatch):
+    folder = tmp_path / 'profiles'
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.profiler.path', str(folder))
+    samples = Counter({'a:main;b:load': 2, 'a:main': 1})
+    filename = save_collapsed_stacks(samples, '/dataset/my-dataset')
+
+    assert 'dataset_my_dataset' in filename
+    with open(filename) as f:
+        assert f.read() == 'a:main;b:load 2\na:main 1\n'
+    # Only the CKAN user can read the profiles
+    assert os.stat(folder).st_mode & 0o777 == 0o700
+    assert os.stat(filename).st_mode & 0o777 == 0o600
+
+
+def test_save_collapsed_stacks_no_folder(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.profiler.path', '')
+    monkeypatch.setitem(ckan_config, 'ckan.storage_path', '')
+    assert save_collapsed_stacks(Counter({'a:main': 1}), '/') is None
+
+
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.max_files', '2')
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.retention_days', '7')
+def test_prune_profiles(tmp_path):
+    now = time.time()
+    ages = {'old.collapsed': 8 * 86400, 'a.collapsed': 30, 'b.collapsed': 20, 'c.collapsed': 10}
+    for name, age in ages.items():
+        filename = tmp_path / name
+        filename.write_text('a:main 1\n')
+        os.utime(filename, (now - age, now - age))
+
+    prune_profiles(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ['b.collapsed', 'c.collapsed']
+
+
+@mock.patch('ckanext.push_errors.profiler.can_send_profile', return_value=True)
+@mock.patch('ckanext.push_errors.profiler.save_collapsed_stacks', return_value='/tmp/profile.collapsed')
+@mock.patch('ckanext.push_errors.profiler.push_message')
+def test_report_profile(mock_push_message, _save, _can_send):
+    samples = Counter({'a:main;b:load': 3, 'a:main;c:parse': 1})
+    report_profile(samples, 2500, '/dataset/')
+
+    mock_push_message.assert_called_once()
+    msg = mock_push_message.call_args[0][0]
+    assert 'SLOW_REQUEST `/dataset/` took 2500 ms' in msg
+    assert 'b:load' in msg
+    assert '75.0%' in msg
+    assert '/tmp/profile.collapsed' in msg
+    # Profiles do not use the errors limits
+    assert mock_push_message.call_args[1]['check_limits'] is False
+
+
+@mock.patch('ckanext.push_errors.profiler.can_send_profile', return_value=False)
+@mock.patch('ckanext.push_errors.profiler.save_collapsed_stacks')
+@mock.patch('ckanext.push_errors.profiler.push_message')
+def test_report_profile_over_limits(mock_push_message, mock_save, _can_send):
+    """ Profiles over the limits are saved but not pushed """
+    samples = Counter({'a:main': 1})
+    report_profile(samples, 2500, '/dataset/')
+    mock_save.assert_called_once_with(samples, '/dataset/')
+    mock_push_message.assert_not_called()
+
+
+@mock.patch('ckanext.push_errors.profiler.can_send_profile', return_value=False)
+@mock.patch('ckanext.push_errors.profiler.push_message')
+def test_rate_limited_profile_is_saved(mock_push_message, _can_send, tmp_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'ckanext.push_errors.profiler.path', str(tmp_path))
+    report_profile(Counter({'a:main;b:load': 2}), 2500, '/dataset/')
+
+    mock_push_message.assert_not_called()
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert (tmp_path / profiles[0]).read_text() == 'a:main;b:load 2\n'
+
+
+@mock.patch('ckanext.push_errors.profiler.report_profile')
+def test_reporter_runs_in_background(mock_report):
+    reporter = ProfileReporter()
+    samples = Counter({'a:main': 1})
+    reporter.put(samples, 2500, '/dataset/')
+    reporter.queue.join()
+
+    mock_report.assert_called_once_with(samples, 2500, '/dataset/')
+    assert reporter._thread is not threading.current_thread()
+
+
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.enabled', 'true')
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.threshold_ms', '0')
+@mock.patch('ckanext.push_errors.profiler.get_reporter')
+@mock.patch('ckanext.push_errors.profiler.get_sampler')
+def test_slow_request_is_reported(mock_get_sampler, mock_get_reporter, app):
+    mock_get_sampler.return_value.stop.return_value = Counter({'a:main': 1})
+    app.get(url_for('home.index'))
+    mock_get_reporter.return_value.put.assert_called()
+    _samples, elapsed_ms, path = mock_get_reporter.return_value.put.call_args[0]
+    assert path == '/'
+
+
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.enabled', 'true')
+@pytest.mark.ckan_config('ckanext.push_errors.profiler.threshold_ms', '600000')
+@mock.patch('ckanext.push_errors.profiler.get_reporter')
+def test_fast_request_is_not_reported(mock_get_reporter, app):
+    app.get(url_for('home.index'))
+    mock_get_reporter.assert_not_called()
+
+
+@mock.patch('ckanext.push_errors.profiler.profiling_window_open', return_value=False)
+@mock.patch('ckanext.push_errors.profiler.get_sampler')
+def test_profiler_disabled(mock_get_sampler, _window, app):
+    app.get(url_for('home.index'))
+    mock_get_sampler.assert_not_called()
+
+
+def test_get_cache_reuses_client():
+    """ The profiling window is checked on every request, do not open new connections """
+    assert get_cache() is get_cache()
+
+
+class TestProfileView:
+    """Tests for the profiling window view"""
+
+    @mock.patch('ckanext.push_errors.blueprints.push_errors.open_profiling_window')
+    def test_unauthorized_not_sysadmin(self, mock_open, app):
+        user_with_token = factories.UserWithToken()
+        auth = {"Authorization": user_with_token['token']}
+        response = app.post(url_for('push_errors.profile'), data={'seconds': 60}, headers=auth)
+
+        assert response.status_code == 403
+        mock_open.assert_not_called()
+
+    @mock.patch('ckanext.push_errors.blueprints.push_errors.open_profiling_window')
+    def test_get_does_not_open_window(self, mock_open, app):
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        response = app.get(url_for('push_errors.profile', seconds=60), headers=auth)
+
+        assert response.status_code == 200
+        assert b'Start profiling' in response.data
+        mock_open.assert_not_called()
+
+    @mock.patch('ckanext.push_errors.profiler.get_cache')
+    def test_sysadmin_opens_window(self, mock_get_cache, app):
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        response = app.post(
+            url_for('push_errors.profile'), data={'seconds': 99999}, headers=auth, follow_redirects=False
+        )
+
+        assert response.status_code == 302
+        cache = mock_get_cache.return_value
+        cache.set.assert_called_once_with(
+            profiler.WINDOW_KEY, mock.ANY, ex=profiler.MAX_WINDOW_SECONDS
+        )
+
+    def test_invalid_seconds(self, app):
+        sysadmin_with_token = factories.SysadminWithToken()
+        auth = {"Authorization": sysadmin_with_token['token']}
+        response = app.post(url_for('push_errors.profile'), data={'seconds': 'abc'}, headers=auth)
+
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('token_auth, protected', [(False, True), (True, False)])
+    @mock.patch('ckanext.push_errors.blueprints.push_errors.open_profiling_window', return_value=60)
+    @mock.patch('ckanext.push_errors.blueprints.push_errors.csrf')
+    def test_csrf_enforced(self, mock_csrf, mock_open, app, token_auth, protected):
+        """ The view is CSRF protected (but for API tokens) even if extensions are exempt """
+        with app.flask_app.test_request_context('/push-error/profile', method='POST', data={'seconds': 60}):
+            toolkit.g.userobj = mock.MagicMock(sysadmin=True)
+            toolkit.g.login_via_auth_header = token_auth
+            profile()
+
+        assert mock_csrf.protect.called is protected
+        mock_open.assert_called_once_with(60)
@@ -55,7 +55,7 @@ def test_middleware_handles_multiple_exceptions(mock_push_message, exception):
     if isinstance(exception, (Unauthorized, Forbidden, NotFound)):
         mock_push_message.assert_not_called()
     else:
-        mock_push_message.assert_called_once_with(ANY)
+        mock_push_message.assert_called_once_with(ANY, extra_context=ANY)
 
 
 @pytest.mark.ckan_config("ckanext.push_errors.traceback_length", "1000")